@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+
+"""
+Measures what pymistake costs: interpreter startup with and without
+`usercustomize.py`, `excepthook` latency vs. traceback depth, `is_dev_file`
+with many installed distributions, and `format_exception` with and without
+`colored`.
+
+Results are written as JSON, and can be compared against a previous run with
+`--compare`.
+"""
+
+from __future__ import print_function
+
+import argparse
+from contextlib import contextmanager
+import io
+import json
+import os
+from os.path import abspath, dirname, join
+import platform
+import shutil
+import site
+import subprocess
+import sys
+import tempfile
+import time
+
+
+pymistake_dir = dirname(abspath(__file__))
+
+
+def summarize(times_s):
+    """Returns dict of summary statistics, in milliseconds."""
+    times_ms = sorted(t * 1000 for t in times_s)
+    return {
+        'n': len(times_ms),
+        'min_ms': times_ms[0],
+        'median_ms': times_ms[len(times_ms) // 2],
+        'max_ms': times_ms[-1],
+    }
+
+
+def time_calls(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return summarize(times)
+
+
+@contextmanager
+def env_vars(**kwargs):
+    old = {k: os.environ.get(k) for k in kwargs}
+    os.environ.update(kwargs)
+    try:
+        yield
+    finally:
+        for k, v in old.items():
+            if v is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = v
+
+
+def pythonpath_without_pymistake():
+    paths = os.environ.get('PYTHONPATH', '').split(os.pathsep)
+    return [p for p in paths if p and abspath(p) != pymistake_dir]
+
+
+def bench_startup(repeats):
+    """Times `python -c pass` with and without pymistake on PYTHONPATH.
+
+    Subprocesses are not attended, so this measures importing
+    `usercustomize.py`, not installing the hook.
+    """
+    results = {'user_site_enabled': site.ENABLE_USER_SITE}
+    base_paths = pythonpath_without_pymistake()
+    for name, paths in (('without_pymistake', base_paths),
+        ('with_pymistake', base_paths + [pymistake_dir])):
+
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(paths))
+        times = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            subprocess.check_call([sys.executable, '-c', 'pass'], env=env)
+            times.append(time.perf_counter() - t0)
+        results[name] = summarize(times)
+
+    results['overhead_median_ms'] = (results['with_pymistake']['median_ms'] -
+        results['without_pymistake']['median_ms']
+    )
+    return results
+
+
+def _raise_at_depth(depth):
+    if depth > 1:
+        return _raise_at_depth(depth - 1)
+    raise ValueError('benchmark')
+
+
+def exc_info_at_depth(depth):
+    try:
+        _raise_at_depth(depth)
+    except ValueError:
+        return sys.exc_info()
+
+
+def bench_excepthook(depths, repeats):
+    """Times `excepthook` end-to-end (minus the debugger) vs. traceback depth.
+    """
+    from util import is_dev_file
+    from excepthook import excepthook, set_file_filter
+
+    set_file_filter(is_dev_file)
+    old_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(old_limit, max(depths) + 1000))
+    results = {}
+    try:
+        # Pinning every setting that changes what the hook does, so results
+        # don't depend on the environment, and so nothing gets recorded in the
+        # user's crash database.
+        with env_vars(PYMISTAKE_DEBUG_UNCAUGHT='0', PYMISTAKE_TRACEBACK='1',
+            PYMISTAKE_MEMORY='0', PYMISTAKE_RECORD_CRASHES='0',
+            PYMISTAKE_PROFILE='0'):
+            for depth in depths:
+                exc_info = exc_info_at_depth(depth)
+                old_stderr = sys.stderr
+                sys.stderr = io.StringIO()
+                try:
+                    results[str(depth)] = time_calls(
+                        lambda: excepthook(*exc_info), repeats
+                    )
+                finally:
+                    sys.stderr = old_stderr
+    finally:
+        sys.setrecursionlimit(old_limit)
+    return results
+
+
+_IS_DEV_FILE_CHILD = '''
+import json, sys, time
+from util import is_dev_file
+
+def time_file(f, repeats):
+    t0 = time.perf_counter()
+    is_dev_file(f)
+    first_ms = (time.perf_counter() - t0) * 1000
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        is_dev_file(f)
+        times.append((time.perf_counter() - t0) * 1000)
+    times.sort()
+    return {'first_ms': first_ms, 'median_ms': times[len(times) // 2]}
+
+repeats = int(sys.argv[3])
+print(json.dumps({
+    'non_dev': time_file(sys.argv[1], repeats),
+    'unlisted': time_file(sys.argv[2], repeats),
+}))
+'''
+
+def make_synthetic_site_packages(root, n_dists):
+    site_packages = join(root, 'site-packages')
+    os.makedirs(site_packages)
+    for i in range(n_dists):
+        name = 'pymistake_bench_pkg{}'.format(i)
+        os.makedirs(join(site_packages, name))
+        with open(join(site_packages, name, '__init__.py'), 'w'):
+            pass
+
+        dist_info = join(site_packages, '{}-1.0.dist-info'.format(name))
+        os.makedirs(dist_info)
+        with open(join(dist_info, 'METADATA'), 'w') as f:
+            f.write('Metadata-Version: 2.1\nName: {}\nVersion: 1.0\n'.format(
+                name
+            ))
+        with open(join(dist_info, 'RECORD'), 'w') as f:
+            f.write('{}/__init__.py,,\n'.format(name))
+            for fname in ('METADATA', 'RECORD'):
+                f.write('{}-1.0.dist-info/{},,\n'.format(name, fname))
+    return site_packages
+
+
+def bench_is_dev_file(n_dists_list, repeats):
+    """
+    Times `is_dev_file` with N synthetic distributions importable, for a file
+    under site-packages and for a file under neither the dev nor the non-dev
+    dirs (which falls through to looking the file up among installed
+    distributions). Each N runs in a fresh interpreter, so `first_ms` includes
+    one-time costs.
+
+    Skipped if this pip can't look up distributions (see
+    `util.get_installed_distributions_fn`), as nothing would depend on N.
+    """
+    from util import get_installed_distributions_fn
+    if get_installed_distributions_fn() is None:
+        return {'skipped': 'this pip has no get_installed_distributions, so '
+            'is_dev_file does not look up installed distributions'
+        }
+
+    results = {}
+    for n_dists in n_dists_list:
+        root = tempfile.mkdtemp(prefix='pymistake_bench_')
+        try:
+            site_packages = make_synthetic_site_packages(root, n_dists)
+            other_dir = join(root, 'other')
+            dev_dir = join(root, 'dev')
+            os.makedirs(other_dir)
+            os.makedirs(dev_dir)
+            other_file = join(other_dir, 'mod.py')
+            with open(other_file, 'w'):
+                pass
+
+            env = dict(os.environ,
+                PYTHONPATH=os.pathsep.join([pymistake_dir, site_packages]),
+                PYMISTAKE_DEV_DIRS=dev_dir,
+                PYMISTAKE_NON_DEV_DIRS='site-packages:dist-packages'
+            )
+            out = subprocess.check_output([sys.executable, '-c',
+                _IS_DEV_FILE_CHILD,
+                join(site_packages, 'pymistake_bench_pkg0', '__init__.py'),
+                other_file, str(repeats)], env=env, cwd=root
+            )
+            results[str(n_dists)] = json.loads(out.decode('utf-8'))
+        finally:
+            shutil.rmtree(root)
+    return results
+
+
+def bench_format_exception(depth, repeats):
+    """Times `format_exception` with and without `colored` importable."""
+    from util import is_dev_file
+    from excepthook import format_exception, set_file_filter
+
+    set_file_filter(is_dev_file)
+    exc_info = exc_info_at_depth(depth)
+    results = {'depth': depth}
+
+    try:
+        import colored
+        results['with_colored'] = time_calls(
+            lambda: format_exception(*exc_info), repeats
+        )
+    except ImportError:
+        results['with_colored'] = None
+
+    # Makes `import colored` raise ImportError.
+    old = sys.modules.get('colored')
+    sys.modules['colored'] = None
+    try:
+        results['without_colored'] = time_calls(
+            lambda: format_exception(*exc_info), repeats
+        )
+    finally:
+        if old is None:
+            del sys.modules['colored']
+        else:
+            sys.modules['colored'] = old
+
+    return results
+
+
+def flatten(d, prefix=''):
+    flat = {}
+    for k, v in d.items():
+        key = prefix + k
+        if isinstance(v, dict):
+            flat.update(flatten(v, key + '.'))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            flat[key] = v
+    return flat
+
+
+def compare(old_results, new_results, threshold=0.2):
+    """
+    Prints timings that changed by more than `threshold` (as a fraction of the
+    old value) between two sets of results.
+    """
+    old = flatten(old_results['results'])
+    new = flatten(new_results['results'])
+    n_changed = 0
+    for key in sorted(set(old) & set(new)):
+        if not key.endswith('_ms') or old[key] <= 0:
+            continue
+
+        change = (new[key] - old[key]) / old[key]
+        if abs(change) > threshold:
+            n_changed += 1
+            print('{}: {:.3f} -> {:.3f} ({:+.0f}%)'.format(key, old[key],
+                new[key], change * 100
+            ))
+
+    if n_changed == 0:
+        print('No timings changed by more than {:.0f}%'.format(threshold * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-o', '--output',
+        help='file to write JSON results to (default: stdout)'
+    )
+    parser.add_argument('--compare', metavar='OLD_JSON',
+        help='results of a previous run, to print changes relative to'
+    )
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--depths', type=int, nargs='+',
+        default=[10, 100, 1000, 5000],
+        help='traceback depths for the excepthook benchmark'
+    )
+    parser.add_argument('--n-dists', type=int, nargs='+',
+        default=[10, 100, 1000],
+        help='numbers of synthetic distributions for the is_dev_file benchmark'
+    )
+    args = parser.parse_args()
+
+    # Importing pymistake modules from this directory, whatever PYTHONPATH is.
+    if pymistake_dir not in sys.path:
+        sys.path.insert(0, pymistake_dir)
+
+    results = {
+        'startup': bench_startup(args.repeats),
+        'excepthook': bench_excepthook(args.depths, args.repeats),
+        'is_dev_file': bench_is_dev_file(args.n_dists, args.repeats),
+        'format_exception': bench_format_exception(100, args.repeats),
+    }
+    output = {
+        'python': sys.version,
+        'platform': platform.platform(),
+        'time': time.time(),
+        'results': results,
+    }
+
+    json_str = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json_str + '\n')
+    else:
+        print(json_str)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old_output = json.load(f)
+        compare(old_output, output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+"""
+Records uncaught exceptions in a local SQLite database, grouped by a
+fingerprint, so the same bug recurring across many runs can be told apart from
+new failures.
+
+Run this file to list the most common fingerprints.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+from os.path import expanduser, dirname, isabs, abspath, relpath
+import sys
+import time
+import traceback
+import warnings
+
+from util import envvar_dir_list
+
+
+# Recording should never hold up the crashing process for long. If the database
+# is locked for longer than this, the occurrence is appended to a spool file
+# instead, to be written in the same transaction as the next occurrence that
+# does get the lock.
+BUSY_TIMEOUT_S = 0.005
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS occurrences (
+    fingerprint TEXT NOT NULL,
+    time REAL NOT NULL,
+    argv TEXT
+);
+CREATE INDEX IF NOT EXISTS occurrences_fingerprint
+    ON occurrences (fingerprint);
+CREATE TABLE IF NOT EXISTS samples (
+    fingerprint TEXT PRIMARY KEY,
+    exc_type TEXT,
+    focus TEXT,
+    traceback TEXT
+);
+'''
+
+
+def get_db_path():
+    return expanduser(os.getenv('PYMISTAKE_CRASH_DB',
+        '~/.pymistake/crashes.db'
+    ))
+
+
+def get_root_dirs():
+    """
+    Returns groups of directories to name files relative to, in order of
+    precedence, for `normalize_filename`: the dev dirs (as in
+    `util.is_dev_file`), then `sys.path`.
+    """
+    dev_dirs = envvar_dir_list('PYMISTAKE_DEV_DIRS', [expanduser('~')])
+    return [dev_dirs, [abspath(p) for p in sys.path if p]]
+
+
+def _relative_to_dirs(path, parts, dirs):
+    # Relative to the most specific of `dirs`. Entries that aren't absolute
+    # paths match any part of the path, as in `PYMISTAKE_DEV_DIRS`.
+    best = None
+    for d in dirs:
+        if isabs(d):
+            if not path.startswith(d.rstrip(os.sep) + os.sep):
+                continue
+            rel = relpath(path, d).replace(os.sep, '/')
+
+        elif d in parts[:-1]:
+            i = len(parts) - 1 - parts[::-1].index(d)
+            rel = '/'.join(parts[i:])
+        else:
+            continue
+
+        if best is None or len(rel) < len(best):
+            best = rel
+    return best
+
+
+def normalize_filename(filename, root_dirs):
+    """
+    Drops the parts of a path that vary between machines / environments, so
+    the same code gets the same name wherever it is run from.
+
+    Installed files are named relative to their site-packages directory. Other
+    files are named relative to a directory from the first group in `root_dirs`
+    (see `get_root_dirs`) that contains them, so files from different projects
+    under the same dev dir don't share names.
+    """
+    parts = filename.replace('\\', '/').split('/')
+    for i in range(len(parts) - 1, -1, -1):
+        if parts[i] in ('site-packages', 'dist-packages'):
+            return '/'.join(parts[i + 1:])
+
+    path = abspath(filename)
+    for dirs in root_dirs:
+        rel = _relative_to_dirs(path, parts, dirs)
+        if rel is not None:
+            return rel
+    return parts[-1]
+
+
+def frame_key(frame_summary, root_dirs):
+    # Line numbers are left out, so unrelated edits to a file don't change
+    # fingerprints.
+    return '{}:{}'.format(normalize_filename(frame_summary.filename,
+        root_dirs), frame_summary.name
+    )
+
+
+def fingerprint(etype, stack_summary, focus_idx=None):
+    """Returns (fingerprint, focus) for an exception.
+
+    Built from the exception type, the focus frame (see
+    `excepthook.stack_summary2focus_frame_idx`) and the sequence of frames,
+    with consecutive repeats collapsed, so recursion depth doesn't matter.
+    """
+    root_dirs = get_root_dirs()
+    keys = []
+    for frame_summary in stack_summary:
+        key = frame_key(frame_summary, root_dirs)
+        if not keys or keys[-1] != key:
+            keys.append(key)
+
+    if focus_idx is not None:
+        focus = frame_key(stack_summary[focus_idx], root_dirs)
+    else:
+        focus = None
+
+    exc_name = '{}.{}'.format(etype.__module__, etype.__name__)
+    h = hashlib.sha1()
+    h.update(json.dumps([exc_name, focus, keys]).encode('utf-8'))
+    return h.hexdigest()[:16], focus
+
+
+def _spool_path(db_path):
+    return db_path + '.spool'
+
+
+def _connect(db_path):
+    import sqlite3
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_S)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def _take_spool(db_path):
+    spool = _spool_path(db_path)
+    if not os.path.exists(spool):
+        return []
+
+    # Renaming first, so other processes can't append to what we are about to
+    # delete.
+    taken = '{}.{}'.format(spool, os.getpid())
+    try:
+        os.rename(spool, taken)
+    except OSError:
+        return []
+
+    records = []
+    try:
+        with open(taken) as f:
+            for l in f:
+                if not l.strip():
+                    continue
+                try:
+                    records.append(json.loads(l))
+                # e.g. from a process that died mid-write.
+                except ValueError:
+                    warnings.warn('skipping malformed line in crash spool {}'
+                        .format(spool)
+                    )
+    finally:
+        os.remove(taken)
+    return records
+
+
+def _append_spool(db_path, records):
+    # One `os.write` per record, on a file opened for appending, so records
+    # from concurrent processes can't interleave (as with buffered writes,
+    # which get split into several writes for long tracebacks).
+    fd = os.open(_spool_path(db_path), os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+        0o644
+    )
+    try:
+        for r in records:
+            os.write(fd, (json.dumps(r) + '\n').encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def write_records(records, db_path=None):
+    """Writes records, along with any spooled ones, in one transaction.
+
+    Falls back to spooling them if the database can't be written quickly.
+    """
+    import sqlite3
+    if db_path is None:
+        db_path = get_db_path()
+
+    records = _take_spool(db_path) + list(records)
+    try:
+        conn = _connect(db_path)
+        try:
+            with conn:
+                conn.executemany('INSERT INTO occurrences VALUES (?, ?, ?)',
+                    [(r['fingerprint'], r['time'], r['argv']) for r in records]
+                )
+                conn.executemany('INSERT OR IGNORE INTO samples VALUES '
+                    '(?, ?, ?, ?)', [(r['fingerprint'], r['exc_type'],
+                    r['focus'], r['traceback']) for r in records]
+                )
+        finally:
+            conn.close()
+
+    except sqlite3.OperationalError:
+        _append_spool(db_path, records)
+
+
+def record_crash(etype, value, tb, stack_summary=None, focus_idx=None):
+    """Records an uncaught exception. Called from `excepthook.excepthook`.
+
+    If `stack_summary` is passed, `focus_idx` should be its focus frame index,
+    as computed by `excepthook.stack_summary2focus_frame_idx`. Otherwise both
+    are computed here.
+    """
+    db_path = get_db_path()
+    db_dir = dirname(db_path)
+    if db_dir:
+        # Other processes may be creating it at the same time.
+        os.makedirs(db_dir, exist_ok=True)
+
+    if stack_summary is None:
+        from excepthook import stack_summary2focus_frame_idx
+        stack_summary = traceback.extract_tb(tb)
+        focus_idx = stack_summary2focus_frame_idx(stack_summary)
+
+    fp, focus = fingerprint(etype, stack_summary, focus_idx=focus_idx)
+    record = {
+        'fingerprint': fp,
+        'time': time.time(),
+        'argv': ' '.join(sys.argv),
+        'exc_type': etype.__name__,
+        'focus': focus,
+        'traceback': ''.join(traceback.format_exception(etype, value, tb)),
+    }
+    write_records([record], db_path=db_path)
+    return fp
+
+
+def top_fingerprints(n=10, db_path=None):
+    """
+    Returns list of (fingerprint, count, first_seen, last_seen, exc_type, focus,
+    sample_traceback) tuples, most frequent first.
+    """
+    if db_path is None:
+        db_path = get_db_path()
+
+    # Nothing else is waiting on us here, so no need to give up early.
+    conn = _connect(db_path)
+    conn.execute('PRAGMA busy_timeout = 5000')
+    try:
+        return conn.execute('''
+            SELECT o.fingerprint, COUNT(*), MIN(o.time), MAX(o.time),
+                s.exc_type, s.focus, s.traceback
+            FROM occurrences o LEFT JOIN samples s USING (fingerprint)
+            GROUP BY o.fingerprint
+            ORDER BY COUNT(*) DESC, MAX(o.time) DESC
+            LIMIT ?''', (n,)
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=10,
+        help='number of fingerprints to list'
+    )
+    parser.add_argument('--db', help='overrides PYMISTAKE_CRASH_DB')
+    args = parser.parse_args()
+
+    db_path = args.db if args.db is not None else get_db_path()
+    if not os.path.exists(db_path):
+        warnings.warn('no crash database at {}'.format(db_path))
+        return
+
+    # So anything that couldn't be written quickly at crash time is counted.
+    write_records([], db_path=db_path)
+
+    def fmt_time(t):
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+
+    for fp, count, first, last, exc_type, focus, tb_str in top_fingerprints(
+        n=args.n, db_path=db_path):
+
+        print('{}  count: {}  first: {}  last: {}'.format(fp, count,
+            fmt_time(first), fmt_time(last)
+        ))
+        print('{} in {}'.format(exc_type, focus))
+        print(tb_str)
+
+
+if __name__ == '__main__':
+    main()
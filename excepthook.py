@@ -8,10 +8,11 @@ from __future__ import print_function
 
 import os
 import sys
+import time
 import traceback
 import warnings
 
-from util import get_bool_env_var, _debug
+from util import get_bool_env_var, get_float_env_var, _debug
 
 
 _emph_file_test_fn = None
@@ -25,8 +26,46 @@ def set_file_filter(fn):
     _emph_file_test_fn = fn
 
 
+# Seconds spent in each phase of `excepthook`, if PYMISTAKE_PROFILE is set.
+_profile_times = None
+_debugger_start_t0 = None
+_debugger_start_classification_t0 = None
+def _classification_time():
+    return (_profile_times or {}).get('classification', 0.0)
+
+
+def _profile_add(phase, t0, classification_t0=None):
+    """Adds time since `t0` (from `time.perf_counter()`) to `phase`.
+
+    If `classification_t0` (from `_classification_time()`, taken along with
+    `t0`) is passed, any classification since then is excluded, as it is
+    already counted in its own phase.
+    """
+    if _profile_times is not None:
+        elapsed = time.perf_counter() - t0
+        if classification_t0 is not None:
+            elapsed -= _classification_time() - classification_t0
+        _profile_times[phase] = _profile_times.get(phase, 0.0) + elapsed
+
+
+def print_profile():
+    """Prints (once) time spent in each phase of `excepthook` so far."""
+    global _profile_times
+    if not _profile_times:
+        return
+
+    print('pymistake profile: ' + ', '.join('{} {:.1f} ms'.format(phase,
+        t * 1000) for phase, t in _profile_times.items()), file=sys.stderr
+    )
+    _profile_times = None
+
+
+# Default for `focus_idx` kwargs, since `None` means there is no focus frame.
+_COMPUTE = object()
+
 # TODO make sure edge cases are handled correct (None mostly)
 def stack_summary2focus_frame_idx(stack_summary):
+    t0 = time.perf_counter()
     emphasis_idx = None
     # TODO i should probably just err if this is `None` at this point...
     if _emph_file_test_fn:
@@ -48,6 +87,7 @@ def stack_summary2focus_frame_idx(stack_summary):
             if should_emph:
                 emphasis_idx = i
 
+    _profile_add('classification', t0)
     return emphasis_idx
 
 
@@ -56,7 +96,10 @@ def traceback2n_frames_to_skip(tb):
     # TODO may need to hardcode limit=None
     stack_summary = traceback.extract_tb(tb)
     emphasis_idx = stack_summary2focus_frame_idx(stack_summary)
+    return focus_frame_idx2n_frames_to_skip(stack_summary, emphasis_idx)
 
+
+def focus_frame_idx2n_frames_to_skip(stack_summary, emphasis_idx):
     # TODO TODO probably just assert emphasis_idx is not None, and avoid
     # setting former to 0 first? think about when it might need to be `None`
     # though
@@ -112,6 +155,35 @@ def style(s, fg_color_str_or_dict):
     return stylize(s, *style_strs)
 
 
+def frame_idx2line_idx(stack_summary, frame_idx):
+    """
+    Returns index of the element of `stack_summary.format()` for the frame at
+    `frame_idx`, which can differ from `frame_idx` because `format` collapses
+    runs of repeated frames (e.g. from recursion).
+    """
+    cutoff = getattr(traceback, '_RECURSIVE_CUTOFF', 3)
+    line_idx = -1
+    last_key = None
+    count = 0
+    for i, frame_summary in enumerate(stack_summary):
+        key = (frame_summary.filename, frame_summary.lineno, frame_summary.name)
+        if key != last_key:
+            # For the "[Previous line repeated ...]" line.
+            if count > cutoff:
+                line_idx += 1
+            last_key = key
+            count = 0
+
+        count += 1
+        if count <= cutoff:
+            line_idx += 1
+
+        if i == frame_idx:
+            return line_idx
+
+    return None
+
+
 # Options to consider for formatters (preformat_line_fn / etc):
 # https://github.com/cknd/stackprinter
 # https://pypi.org/project/colored-traceback/
@@ -124,34 +196,91 @@ def style(s, fg_color_str_or_dict):
 #   erics_vim_syntax_and_color_highlighting/blob/master/usercustomize.py
 # https://github.com/nir0s/backtrace
 
-def format_exception(etype, value, tb, limit=None,
+def format_exception(etype, value, tb, limit=None, annotate_memory=False,
+    memory_top_n=3, memory_min_bytes=1 << 20, memory_time_budget_s=0.1,
+    **kwargs):
+    """
+    Args:
+    annotate_memory (bool): If True, frames with locals retaining at least
+        `memory_min_bytes` get a line listing the `memory_top_n` heaviest of
+        them, and the top `tracemalloc` allocation sites are appended if it is
+        tracing. Estimates stop after `memory_time_budget_s`, or after a fixed
+        number of objects. See `memsize.py`.
+
+    See `format_stack_summary` for the keyword arguments controlling emphasis.
+    """
+    # A stack summary is *like* a list of FrameSummary objects.
+    # Note: could pass capture_locals=True to StackSummary.extract based
+    # equivalent to this call if I wanted to do something with the locals.
+    stack_summary = traceback.extract_tb(tb, limit=limit)
+
+    trailing_lines = []
+    if annotate_memory:
+        # Falling back to the unannotated traceback on any failure (including
+        # running out of memory while estimating).
+        try:
+            import memsize
+
+            frame_memory, complete = memsize.traceback2frame_memory(tb,
+                limit=limit, top_n=memory_top_n, min_bytes=memory_min_bytes,
+                time_budget_s=memory_time_budget_s
+            )
+            frame_annotations = memsize.frame_memory2annotations(frame_memory)
+            if not complete:
+                trailing_lines.append('\n(memory estimates incomplete: ran '
+                    'out of time or objects to check)\n'
+                )
+            trailing_lines.extend(memsize.tracemalloc_lines(
+                top_n=memory_top_n
+            ))
+            kwargs['frame_annotations'] = frame_annotations
+
+        except Exception as e:
+            trailing_lines = ['\n(memory annotation failed: {!r})\n'.format(e)]
+
+    return format_stack_summary(stack_summary,
+        traceback.format_exception_only(etype, value), **kwargs
+    ) + trailing_lines
+
+
+def format_stack_summary(stack_summary, exception_lines,
     emphasis_prefix='>', deemphasis_prefix=' ',
     emphasis_prefix_replace=True, deemphasis_prefix_replace=False,
     emphasis_prefix_style=None, emphasis_line_style=None,
     deemphasis_line_style=None, post_emphasis_delim='\n', pre_err_delim='\n',
-    stack_summary2lines_fn=None, preformat_lines_fn=None):
+    stack_summary2lines_fn=None, preformat_lines_fn=None,
+    frame_annotations=None, focus_idx=_COMPUTE):
     """
     Args:
+    stack_summary (`traceback.StackSummary`): frames to format. Need not come
+        from a live traceback (e.g. can be built from `FrameSummary` objects
+        parsed out of a log).
+
+    exception_lines (list of str): appended after the formatted frames, as
+        `traceback.format_exception_only` would generate.
+
     stack_summary2lines_fn (function): If specified, this is called on the
         `StackSummary` to generate lines to process, rather than the summary
         object's own `format()` method.
 
+    frame_annotations (dict): Maps frame indices to lists of lines to add below
+        those frames. Ignored if `stack_summary2lines_fn` is specified.
+
+    focus_idx (int or None): Index of frame to emphasize, if already computed
+        with `stack_summary2focus_frame_idx` (`None` for no emphasis).
+
     See `style` for appropriate input to `*_style` kwargs.
     """
-    # etype and value are only used at the end, not in formatting traceback.
-
     if emphasis_prefix_style is None:
         emphasis_prefix_style = {'fg': 'red', 'attr': 'bold'}
 
     if emphasis_line_style is None:
         emphasis_line_style = {'attr': 'bold'}
 
-    # Note: could pass capture_locals=True to StackSummary.extract based
-    # equivalent to this call if I wanted to do something with the locals.
-
-    # A stack summary is *like* a list of FrameSummary objects.
-    stack_summary = traceback.extract_tb(tb, limit=limit)
-    emphasis_idx = stack_summary2focus_frame_idx(stack_summary)
+    if focus_idx is _COMPUTE:
+        emphasis_idx = stack_summary2focus_frame_idx(stack_summary)
+    else:
+        emphasis_idx = focus_idx
 
     stylized_emph_prefix = style(emphasis_prefix, emphasis_prefix_style)
     def modify_line(single_line, emph=True):
@@ -180,6 +309,18 @@ def format_exception(etype, value, tb, limit=None,
         lines = stack_summary2lines_fn(stack_summary)
     else:
         lines = stack_summary.format()
+        if emphasis_idx is not None:
+            emphasis_idx = frame_idx2line_idx(stack_summary, emphasis_idx)
+
+        if frame_annotations:
+            lines = list(lines)
+            for frame_idx, annotation_lines in frame_annotations.items():
+                # Frames collapsed as repeats have no line to annotate.
+                line_idx = frame_idx2line_idx(stack_summary, frame_idx)
+                if frame_idx > 0 and line_idx == frame_idx2line_idx(
+                    stack_summary, frame_idx - 1):
+                    continue
+                lines[line_idx] += ''.join(annotation_lines)
 
     if preformat_lines_fn:
         lines = preformat_lines_fn(lines)
@@ -218,9 +359,7 @@ def format_exception(etype, value, tb, limit=None,
     if pre_err_delim is None:
         pre_err_delim = ''
 
-    new_lines.extend([pre_err_delim] +
-        traceback.format_exception_only(etype, value)
-    )
+    new_lines.extend([pre_err_delim] + list(exception_lines))
     return new_lines
 
 
@@ -335,7 +474,30 @@ def monkey_patch_pdb():
     pdb.Pdb.interaction = pdb_interaction
 
 
+def monkey_patch_preloop():
+    """
+    Makes the debugger print the `excepthook` profile (see `print_profile`)
+    right before its first prompt.
+    """
+    import pdb
+    orig_preloop = pdb.Pdb.preloop
+
+    def preloop(self):
+        if _debugger_start_t0 is not None:
+            _profile_add('debugger start', _debugger_start_t0,
+                _debugger_start_classification_t0
+            )
+        print_profile()
+        return orig_preloop(self)
+
+    pdb.Pdb.preloop = preloop
+
+
 def excepthook(etype, value, tb):
+    global _profile_times
+    global _debugger_start_t0
+    global _debugger_start_classification_t0
+
     # TODO allow customizing which errors to skip w/ some kind of config file?
 
     # RHS check is *not* equivalent to `sys.flags.interactive`.
@@ -345,23 +507,73 @@ def excepthook(etype, value, tb):
         # formatting is just coloring.
         sys.__excepthook__(etype, value, tb)
     else:
+        if get_bool_env_var('PYMISTAKE_PROFILE', default=False):
+            _profile_times = {'classification': 0.0}
+
+        # Computed once here, as classifying files can be slow.
+        stack_summary = traceback.extract_tb(tb)
+        focus_idx = stack_summary2focus_frame_idx(stack_summary)
+
         custom_print_exception = get_bool_env_var('PYMISTAKE_TRACEBACK',
             default=True
         )
+        t0 = time.perf_counter()
+        classification_t0 = _classification_time()
         if custom_print_exception:
-            print_exception(etype, value, tb)
+            annotate_memory = issubclass(etype, MemoryError) or \
+                get_bool_env_var('PYMISTAKE_MEMORY', default=False)
+            print_exception(etype, value, tb, annotate_memory=annotate_memory,
+                focus_idx=focus_idx
+            )
         else:
             traceback.print_exception(etype, value, tb)
+        _profile_add('formatting', t0, classification_t0)
+
+        record_crashes = get_bool_env_var('PYMISTAKE_RECORD_CRASHES',
+            default=False
+        )
+        if record_crashes:
+            t0 = time.perf_counter()
+            classification_t0 = _classification_time()
+            try:
+                from crashdb import record_crash
+                record_crash(etype, value, tb, stack_summary=stack_summary,
+                    focus_idx=focus_idx
+                )
+            # Failing to record should never get in the way of debugging.
+            except Exception as e:
+                warnings.warn('could not record crash: {}'.format(e))
+            _profile_add('crash recording', t0, classification_t0)
 
         start_post_mortem = get_bool_env_var('PYMISTAKE_DEBUG_UNCAUGHT',
             default=True
         )
         if not start_post_mortem:
+            print_profile()
             return 
         del start_post_mortem
 
+        # Before anything that imports `pdb` (`monkey_patch_precmd` or
+        # `monkey_patch_pdb`), so that is counted as importing the debugger.
+        t0 = time.perf_counter()
+        classification_t0 = _classification_time()
+
+        idle_timeout = None
+        idle_timeout_s = get_float_env_var('PYMISTAKE_DEBUG_TIMEOUT')
+        if idle_timeout_s is not None and idle_timeout_s <= 0:
+            warnings.warn('ignoring PYMISTAKE_DEBUG_TIMEOUT={} (must be '
+                'positive)'.format(os.environ['PYMISTAKE_DEBUG_TIMEOUT'])
+            )
+        elif idle_timeout_s is not None:
+            from idle_timeout import IdleTimeout, monkey_patch_precmd
+            idle_timeout = IdleTimeout(etype, value, tb, idle_timeout_s)
+            monkey_patch_precmd(idle_timeout)
+
         # TODO document what this provides in pdb / ipdb case (same in latter?)
         monkey_patch_pdb()
+        if _profile_times is not None:
+            monkey_patch_preloop()
+
         try:
             # This will trigger the same ImportError (seems now it's a 
             # ModuleNotFoundError...).
@@ -369,11 +581,20 @@ def excepthook(etype, value, tb):
             # import will point to the original thing.
             monkey_patch_ipdb()
             from ipdb import post_mortem
+            _profile_add('debugger import', t0, classification_t0)
 
-            n_frames_to_skip = traceback2n_frames_to_skip(tb)
+            n_frames_to_skip = focus_frame_idx2n_frames_to_skip(stack_summary,
+                focus_idx
+            )
             # TODO see note where `pdb` command list is constructed about
             # maybe adding a no-op command at end to prevent enter from
             # causing expected "u" commands
+            _debugger_start_t0 = time.perf_counter()
+            _debugger_start_classification_t0 = _classification_time()
+            # Started as late as possible, so importing the debugger doesn't
+            # eat into the time the user has to respond.
+            if idle_timeout is not None:
+                idle_timeout.start()
             post_mortem(tb, commands=['u'] * n_frames_to_skip)
 
         # TODO is there some python version where this really was supposed to be
@@ -384,5 +605,13 @@ def excepthook(etype, value, tb):
         # first call to `monkey_patch_ipdb`.
         except (ModuleNotFoundError, ImportError) as e:
             from pdb import post_mortem
+            _profile_add('debugger import', t0, classification_t0)
+            _debugger_start_t0 = time.perf_counter()
+            _debugger_start_classification_t0 = _classification_time()
+            if idle_timeout is not None:
+                idle_timeout.start()
             post_mortem(tb)
 
+        # In case the debugger never called `preloop`.
+        print_profile()
+
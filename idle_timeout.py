@@ -0,0 +1,191 @@
+
+"""
+Ends post-mortem debugging sessions nobody is attending, so crashed processes
+don't hold onto their resources indefinitely. A summary of the state at the
+crash is written to disk first.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+from os.path import expanduser, join
+import signal
+import sys
+import threading
+import time
+import traceback
+
+
+# How often to check whether there has been any input.
+POLL_INTERVAL_S = 0.05
+MAX_LOCALS = 50
+
+
+def get_dump_dir():
+    return expanduser(os.getenv('PYMISTAKE_DUMP_DIR', '~/.pymistake/dumps'))
+
+
+def _bounded_repr():
+    try:
+        from reprlib import Repr
+    except ImportError:
+        from repr import Repr
+
+    r = Repr()
+    r.maxstring = 200
+    r.maxother = 200
+    r.maxlist = r.maxtuple = r.maxset = r.maxdict = 10
+    return r
+
+
+def state_summary(etype, value, tb):
+    """
+    Returns dict with the traceback, the focus frame and (bounded `repr`s of)
+    its locals.
+    """
+    from excepthook import stack_summary2focus_frame_idx
+
+    stack_summary = traceback.extract_tb(tb)
+    frames = [f for f, _ in traceback.walk_tb(tb)]
+    focus_idx = stack_summary2focus_frame_idx(stack_summary)
+    if focus_idx is None:
+        focus_idx = len(frames) - 1
+
+    summary = {
+        'time': time.time(),
+        'pid': os.getpid(),
+        'argv': sys.argv,
+        'traceback': ''.join(traceback.format_exception(etype, value, tb)),
+    }
+    if focus_idx < 0:
+        return summary
+
+    focus = stack_summary[focus_idx]
+    summary['focus'] = {
+        'filename': focus.filename,
+        'lineno': focus.lineno,
+        'name': focus.name,
+    }
+
+    r = _bounded_repr()
+    local_reprs = {}
+    for name, v in list(frames[focus_idx].f_locals.items())[:MAX_LOCALS]:
+        try:
+            local_reprs[name] = r.repr(v)
+        except Exception as e:
+            local_reprs[name] = '<repr failed: {!r}>'.format(e)
+    summary['locals'] = local_reprs
+    return summary
+
+
+def dump_state(etype, value, tb):
+    """Writes `state_summary` as JSON and returns the path written to."""
+    dump_dir = get_dump_dir()
+    # Other processes may be creating it at the same time.
+    os.makedirs(dump_dir, exist_ok=True)
+
+    path = join(dump_dir, 'pymistake-{}-{}.json'.format(
+        time.strftime('%Y%m%d-%H%M%S'), os.getpid()
+    ))
+    with open(path, 'w') as f:
+        json.dump(state_summary(etype, value, tb), f, indent=2)
+    return path
+
+
+def _stdin_has_input():
+    try:
+        import select
+        readable, _, _ = select.select([sys.stdin], [], [], POLL_INTERVAL_S)
+        return bool(readable)
+    # e.g. on Windows, where `select` only works with sockets.
+    except (ImportError, OSError, ValueError):
+        time.sleep(POLL_INTERVAL_S)
+        return False
+
+
+def _exit_status(etype):
+    # What the interpreter would have exited with, had no debugger started.
+    if issubclass(etype, KeyboardInterrupt):
+        return 128 + signal.SIGINT
+    return 1
+
+
+class IdleTimeout(object):
+    """
+    Call `start` right before starting the debugger. Unless `cancel` is called
+    or there is any input on stdin within `timeout_s` seconds, the state is
+    dumped (see `dump_state`) and the process exits.
+    """
+    def __init__(self, etype, value, tb, timeout_s):
+        self.etype = etype
+        self.value = value
+        self.tb = tb
+        self.timeout_s = timeout_s
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._watch)
+        self._thread.daemon = True
+
+        # The debugger may change the terminal settings (e.g. `ipdb` uses raw
+        # mode), which we need to undo before exiting from another thread.
+        try:
+            import termios
+            self._termios_attrs = termios.tcgetattr(sys.stdin)
+        except Exception:
+            self._termios_attrs = None
+
+    def start(self):
+        # Can be called again if falling back to another debugger.
+        if self._thread.ident is None:
+            self._thread.start()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def _restore_terminal(self):
+        if self._termios_attrs is None:
+            return
+        import termios
+        try:
+            termios.tcsetattr(sys.stdin, termios.TCSANOW, self._termios_attrs)
+        except Exception:
+            pass
+
+    def _watch(self):
+        deadline = time.monotonic() + self.timeout_s
+        while time.monotonic() < deadline:
+            if self._cancelled.is_set() or _stdin_has_input():
+                return
+
+        if self._cancelled.is_set():
+            return
+
+        self._restore_terminal()
+        print('\n\nNo input for {:g}s. Exiting debugger.'.format(
+            self.timeout_s), file=sys.stderr
+        )
+        try:
+            path = dump_state(self.etype, self.value, self.tb)
+            print('State at crash written to {}'.format(path), file=sys.stderr)
+        except Exception as e:
+            print('Failed to write state at crash: {}'.format(e),
+                file=sys.stderr
+            )
+        sys.stderr.flush()
+        # `sys.exit` would only end this thread.
+        os._exit(_exit_status(self.etype))
+
+
+def monkey_patch_precmd(idle_timeout):
+    """
+    Also cancels `idle_timeout` when the debugger runs a command, in case input
+    was consumed between our checks of stdin.
+    """
+    import pdb
+    orig_precmd = pdb.Pdb.precmd
+
+    def precmd(self, line):
+        idle_timeout.cancel()
+        return orig_precmd(self, line)
+
+    pdb.Pdb.precmd = precmd
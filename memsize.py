@@ -0,0 +1,198 @@
+
+"""
+Rough estimates of the memory retained by the locals of each frame in a
+traceback, for annotating tracebacks (see `format_exception` in
+`excepthook.py`).
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+import traceback
+
+
+class _WalkBudget(object):
+    """
+    Limits shared by a whole walk: a number of objects to visit, and a deadline
+    (from `time.monotonic()`). `exhausted` is set once either runs out.
+    """
+    def __init__(self, max_objects, deadline):
+        self.objects_left = max_objects
+        self.deadline = deadline
+        self.exhausted = False
+
+    def spend(self):
+        """Returns whether another object can be visited, counting it if so."""
+        if not self.exhausted and (self.objects_left <= 0 or
+            time.monotonic() > self.deadline):
+            self.exhausted = True
+
+        if self.exhausted:
+            return False
+        self.objects_left -= 1
+        return True
+
+
+def _nbytes(obj):
+    # numpy arrays, pandas Series / Index, etc.
+    nbytes = getattr(obj, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+
+    # pandas DataFrame (no `nbytes`). Not deep, because that would walk every
+    # element of object columns.
+    memory_usage = getattr(obj, 'memory_usage', None)
+    if callable(memory_usage) and hasattr(obj, 'columns'):
+        try:
+            return int(memory_usage(index=True, deep=False).sum())
+        except Exception:
+            pass
+
+    return None
+
+
+def estimate_size(obj, budget, seen, max_depth=3):
+    """Returns estimated bytes retained by `obj`.
+
+    Uses `nbytes` for arrays / DataFrames, otherwise `sys.getsizeof`, recursing
+    into builtin containers down to `max_depth`, for as long as `budget` (a
+    `_WalkBudget`) allows. If it runs out partway through a container, the
+    elements not walked are assumed to be like the ones that were. Objects with
+    their `id` in `seen` count as 0, and `seen` is updated, so shared objects
+    are only counted once.
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = _nbytes(obj)
+    if size is not None:
+        return size
+
+    try:
+        size = sys.getsizeof(obj)
+    except Exception:
+        return 0
+
+    if max_depth <= 0:
+        return size
+
+    if isinstance(obj, dict):
+        children = obj.items()
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        children = obj
+    else:
+        return size
+
+    children_size = 0
+    n_walked = 0
+    for child in children:
+        if not budget.spend():
+            break
+        n_walked += 1
+
+        if isinstance(obj, dict):
+            k, child = child
+            children_size += estimate_size(k, budget, seen, max_depth - 1)
+
+        children_size += estimate_size(child, budget, seen, max_depth - 1)
+
+    # Assuming the elements we didn't get to are like the ones we did.
+    if n_walked and n_walked < len(obj):
+        children_size = int(children_size * len(obj) / float(n_walked))
+
+    return size + children_size
+
+
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n) < 1024:
+            break
+        n /= 1024.0
+    else:
+        unit = 'TB'
+    return '{:.1f} {}'.format(n, unit) if unit != 'B' else '{} B'.format(n)
+
+
+def traceback2frame_memory(tb, limit=None, top_n=3, min_bytes=1 << 20,
+    time_budget_s=0.1, max_objects=100000):
+    """
+    Returns (dict, complete), where dict maps indices into
+    `traceback.extract_tb(tb, limit=limit)` to lists of up to `top_n`
+    (name, bytes) tuples for the heaviest locals of that frame (heaviest first),
+    for frames where the heaviest local retains at least `min_bytes`.
+
+    Frames are checked innermost first, as that is where errors like
+    `MemoryError` are raised. At most `max_objects` objects are visited, across
+    all frames, and `complete` is False if that or `time_budget_s` ran out
+    before all frames were checked. Estimates for the frame being checked when
+    that happened are still included, but may be low.
+    """
+    budget = _WalkBudget(max_objects, time.monotonic() + time_budget_s)
+    frames = [f for f, _ in traceback.walk_tb(tb)]
+    if limit is not None:
+        frames = frames[:limit] if limit >= 0 else frames[limit:]
+
+    # Estimates by object id, so objects passed down through many frames are
+    # only walked once.
+    sizes = {}
+    frame_memory = {}
+    for i in range(len(frames) - 1, -1, -1):
+        if budget.exhausted:
+            return frame_memory, False
+
+        local_sizes = []
+        try:
+            local_items = list(frames[i].f_locals.items())
+        except Exception:
+            continue
+
+        for name, value in local_items:
+            if id(value) not in sizes:
+                try:
+                    sizes[id(value)] = estimate_size(value, budget, set())
+                # Anything can happen in attribute access / `__sizeof__` of
+                # arbitrary objects (e.g. lazy proxies), and that shouldn't
+                # cost the user their traceback.
+                except Exception:
+                    sizes[id(value)] = 0
+            local_sizes.append((name, sizes[id(value)]))
+
+        local_sizes.sort(key=lambda x: x[1], reverse=True)
+        if local_sizes and local_sizes[0][1] >= min_bytes:
+            frame_memory[i] = local_sizes[:top_n]
+
+    return frame_memory, not budget.exhausted
+
+
+def frame_memory2annotations(frame_memory):
+    """Returns dict of frame index -> list of lines, for `format_stack_summary`.
+    """
+    return {i: ['    [memory] ' + ', '.join('{}: {}'.format(name,
+        format_bytes(n)) for name, n in local_sizes) + '\n']
+        for i, local_sizes in frame_memory.items()
+    }
+
+
+def tracemalloc_lines(top_n=3):
+    """
+    Returns lines describing the top allocation sites, or an empty list if
+    `tracemalloc` is not tracing.
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        return []
+
+    if not tracemalloc.is_tracing():
+        return []
+
+    stats = tracemalloc.take_snapshot().statistics('lineno')[:top_n]
+    lines = ['\nTop allocation sites (tracemalloc):\n']
+    for stat in stats:
+        frame = stat.traceback[0]
+        lines.append('  {}:{}: {} in {} blocks\n'.format(frame.filename,
+            frame.lineno, format_bytes(stat.size), stat.count
+        ))
+    return lines
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+"""
+Re-renders plain CPython tracebacks found in log files (e.g. from runs where
+`pymistake` was not active) with the same emphasis `excepthook` would have
+added.
+
+Input is streamed, so memory use does not depend on the size of the logs.
+Non-traceback text is passed through unchanged.
+"""
+
+from __future__ import print_function
+
+import argparse
+from collections import deque
+import io
+import os
+import re
+import sys
+import traceback
+
+from util import is_dev_file
+from excepthook import format_stack_summary, set_file_filter
+
+
+TRACEBACK_HEADER = 'Traceback (most recent call last):'
+
+_frame_re = re.compile(r'^  File "(?P<filename>.*)", line (?P<lineno>\d+), '
+    r'in (?P<name>.*)$'
+)
+# Location of a SyntaxError, from `format_exception_only` (not a stack frame).
+_syntax_error_location_re = re.compile(r'^  File ".*", line \d+$')
+_repeated_re = re.compile(r'^  \[Previous line repeated (?P<n>\d+) more times?\]$')
+# Python 3.11+ adds lines like these under the source line of each frame.
+_caret_re = re.compile(r'^    [ ~^]+$')
+
+
+class TracebackParser(object):
+    """Incrementally finds traceback blocks in lines of text.
+
+    Lines are passed to `feed` one at a time. It returns a list of segments
+    completed by that line, each either a `str` (text to pass through as-is) or
+    a `(prefix, stack_summary, exception_lines, frame_annotations)` tuple.
+    `prefix` is whatever preceded the traceback header on its line (e.g. a log
+    timestamp), which every line of the block is expected to share.
+    `frame_annotations` has any lines found under the source line of a frame
+    (e.g. the position markers of Python 3.11+), as `format_stack_summary`
+    takes them.
+
+    Only the current block is buffered, so memory use is bounded by the size
+    of the largest traceback, not the size of the input.
+    """
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self.prefix = None
+        self._raw_lines = []
+        self._frames = []
+        self._frame_annotations = {}
+
+    @property
+    def in_block(self):
+        return self.prefix is not None
+
+    def _abort(self):
+        # Whatever we had buffered didn't turn out to be a traceback we could
+        # parse, so it is passed through unmodified.
+        segments = list(self._raw_lines)
+        self._reset()
+        return segments
+
+    def feed(self, line):
+        if not self.in_block:
+            idx = line.find(TRACEBACK_HEADER)
+            if idx == -1:
+                return [line]
+
+            self.prefix = line[:idx]
+            self._raw_lines.append(line)
+            return []
+
+        if not line.startswith(self.prefix):
+            # Starting over with this line, because it might be a new header.
+            return self._abort() + self.feed(line)
+
+        self._raw_lines.append(line)
+        content = line[len(self.prefix):].rstrip('\r\n')
+
+        match = _frame_re.match(content)
+        if match:
+            self._frames.append(traceback.FrameSummary(
+                match.group('filename'), int(match.group('lineno')),
+                match.group('name'), lookup_line=False, line=''
+            ))
+            return []
+
+        if _syntax_error_location_re.match(content):
+            # Passing these through as-is, like `excepthook` does. The lines
+            # after this one don't look like part of a block, so they will be
+            # passed through too.
+            return self._abort()
+
+        match = _repeated_re.match(content)
+        if match and self._frames:
+            self._frames.extend([self._frames[-1]] * int(match.group('n')))
+            return []
+
+        if content.startswith('    ') and self._frames:
+            if _caret_re.match(content):
+                self._frame_annotations.setdefault(len(self._frames) - 1,
+                    []).append(content + '\n')
+                return []
+
+            last = self._frames[-1]
+            # Need a new object, since repeated frames share one.
+            self._frames[-1] = traceback.FrameSummary(last.filename,
+                last.lineno, last.name, lookup_line=False, line=content.strip()
+            )
+            return []
+
+        if not content or content.startswith(' ') or not self._frames:
+            # The line ending the block might start a new one, so it is
+            # handled again after the buffered lines are passed through.
+            self._raw_lines.pop()
+            return self._abort() + self.feed(line)
+
+        # First non-indented line after the frames is the exception line.
+        # Any continuation of a multi-line message is passed through as text.
+        block = (self.prefix, traceback.StackSummary.from_list(self._frames),
+            [content + '\n'], self._frame_annotations
+        )
+        self._reset()
+        return [block]
+
+    def close(self):
+        """Returns any remaining segments. Call once input is exhausted."""
+        return self._abort()
+
+
+_filename_cache = None
+_local_cache = {}
+def cached_is_dev_file(filename):
+    """
+    `is_dev_file`, but with results shared across all worker processes, so each
+    filename is only classified once per run.
+    """
+    try:
+        return _local_cache[filename]
+    except KeyError:
+        pass
+
+    ret = _filename_cache.get(filename) if _filename_cache is not None else None
+    if ret is None:
+        ret = is_dev_file(filename)
+        if _filename_cache is not None:
+            _filename_cache[filename] = ret
+
+    _local_cache[filename] = ret
+    return ret
+
+
+def init_worker(filename_cache):
+    global _filename_cache
+    _filename_cache = filename_cache
+    set_file_filter(cached_is_dev_file)
+
+
+def render_segment(segment):
+    if not isinstance(segment, tuple):
+        return segment
+
+    prefix, stack_summary, exception_lines, frame_annotations = segment
+    lines = ''.join(format_stack_summary(stack_summary, exception_lines,
+        frame_annotations=frame_annotations
+    ))
+    return ''.join(prefix + l + '\n' for l in lines.split('\n')[:-1])
+
+
+def render_chunk(lines):
+    """Returns the re-formatted text for a list of lines.
+
+    Chunks must not split any traceback block.
+    """
+    parser = TracebackParser()
+    out = []
+    for line in lines:
+        out.extend(render_segment(s) for s in parser.feed(line))
+    out.extend(render_segment(s) for s in parser.close())
+    return ''.join(out)
+
+
+def iter_chunks(lines, chunk_lines):
+    """Groups `lines` into lists of about `chunk_lines`, without splitting
+    traceback blocks across chunks.
+    """
+    parser = TracebackParser()
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        parser.feed(line)
+        if len(chunk) >= chunk_lines and not parser.in_block:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def iter_input_lines(paths):
+    if not paths:
+        paths = ['-']
+
+    for path in paths:
+        if path == '-':
+            for line in sys.stdin:
+                yield line
+        else:
+            with io.open(path, encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    yield line
+
+
+def reformat(lines, out, jobs=1, chunk_lines=10000):
+    chunks = iter_chunks(lines, chunk_lines)
+
+    if jobs == 1:
+        init_worker(None)
+        for chunk in chunks:
+            out.write(render_chunk(chunk))
+        return
+
+    import multiprocessing
+
+    manager = multiprocessing.Manager()
+    pool = multiprocessing.Pool(jobs, initializer=init_worker,
+        initargs=(manager.dict(),)
+    )
+    # Not using `Pool.imap`, as it consumes its whole input eagerly.
+    # Bounding the number of chunks in flight keeps memory use constant.
+    max_pending = 2 * jobs
+    pending = deque()
+    try:
+        for chunk in chunks:
+            pending.append(pool.apply_async(render_chunk, (chunk,)))
+            if len(pending) >= max_pending:
+                out.write(pending.popleft().get())
+
+        while pending:
+            out.write(pending.popleft().get())
+    finally:
+        pool.terminate()
+        manager.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('paths', nargs='*', metavar='FILE',
+        help="log files to read (default/'-': stdin)"
+    )
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)'
+    )
+    parser.add_argument('--chunk-lines', type=int, default=10000,
+        help='approximate number of lines per chunk sent to each worker'
+    )
+    parser.add_argument('--dev-dirs', help='overrides PYMISTAKE_DEV_DIRS')
+    parser.add_argument('--non-dev-dirs',
+        help='overrides PYMISTAKE_NON_DEV_DIRS'
+    )
+    args = parser.parse_args()
+
+    # Set before any workers start, so they all classify files the same way.
+    if args.dev_dirs is not None:
+        os.environ['PYMISTAKE_DEV_DIRS'] = args.dev_dirs
+
+    if args.non_dev_dirs is not None:
+        os.environ['PYMISTAKE_NON_DEV_DIRS'] = args.non_dev_dirs
+
+    jobs = args.jobs
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    try:
+        reformat(iter_input_lines(args.paths), sys.stdout, jobs=jobs,
+            chunk_lines=args.chunk_lines
+        )
+    except BrokenPipeError:
+        # e.g. when piped to `head`
+        sys.stderr.close()
+
+
+if __name__ == '__main__':
+    main()
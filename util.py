@@ -34,6 +34,19 @@ def get_bool_env_var(var, default=True):
         val = default
     return val
 
+def get_float_env_var(var, default=None):
+    if var not in os.environ:
+        return default
+
+    val = os.environ[var]
+    try:
+        return float(val)
+    except ValueError:
+        warnings.warn('invalid value of {}: {}\n(must be a number)'.format(
+            var, val
+        ))
+        return default
+
 _debug = get_bool_env_var('PYMISTAKE_DEBUG', default=False)
 
 
@@ -111,6 +124,22 @@ def envvar_dir_list(env_var, default):
         return dirs
 
 
+def get_installed_distributions_fn():
+    """
+    Returns pip's `get_installed_distributions`, or `None` if this pip doesn't
+    have it (it was removed in pip 21.3).
+    """
+    # TODO: why is this import so slow?
+    try:
+        from pip.utils import get_installed_distributions
+    except ModuleNotFoundError:
+        try:
+            from pip._internal.utils.misc import get_installed_distributions
+        except ImportError:
+            return None
+    return get_installed_distributions
+
+
 editable_dists = None
 def file_pip_module_info(abs_path):
     """
@@ -120,11 +149,11 @@ def file_pip_module_info(abs_path):
     # Adapted from Github user nbeaver's pip_file_lookup repo (MIT license)
     # Found through: https://stackoverflow.com/questions/33483818
 
-    # TODO: why is this import so slow?
-    try:
-        from pip.utils import get_installed_distributions
-    except ModuleNotFoundError:
-        from pip._internal.utils.misc import get_installed_distributions
+    get_installed_distributions = get_installed_distributions_fn()
+    if get_installed_distributions is None:
+        # Without it, we can't tell which distribution (if any) a file belongs
+        # to.
+        return None
 
     if editable_dists is None:
         # all versions of stuff that could be imported above have this flag?